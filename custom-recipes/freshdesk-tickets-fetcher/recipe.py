@@ -1,11 +1,15 @@
 from dataiku.customrecipe import get_output_names_for_role
 from dataiku.customrecipe import get_recipe_config
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from freshdesktool.cache import DEFAULT_CACHE_TTL, ResponseCache
+from freshdesktool.serialization import dumps
+from freshdesktool.session import create_auth_headers, create_session
 import logging
 import dataiku
 import pandas as pd
 import requests
-import base64
+import math
 import os
 
 config = get_recipe_config()
@@ -34,151 +38,355 @@ logger.setLevel(level)
 logger.info("Starting the Freshdesk tickets fetcher recipe.")
 logger.debug(f"Configuration loaded: {config}")
 
+# Number of concurrent requests used to fetch ticket conversations
+CONVERSATION_WORKERS = 16
+
+# Number of concurrent requests used to fetch search result pages
+SEARCH_WORKERS = 8
+
+# The search API returns 30 tickets per page and at most 10 pages per query
+SEARCH_PAGE_SIZE = 30
+SEARCH_MAX_PAGES = 10
+SEARCH_MAX_RESULTS = SEARCH_PAGE_SIZE * SEARCH_MAX_PAGES
+
+# Lower bound of the creation date windows used to split large searches
+SEARCH_START_DATE = date(2010, 1, 1)
+
+# DSS types of the ticket fields returned by the search API, plus the fetched conversations.
+# The output schema is declared from them rather than inferred from a single page, so that a nullable
+# ID that happens to be set on every ticket of the first page does not make later pages invalid.
+# Nested values (lists and objects) are written as JSON strings.
+TICKET_COLUMN_TYPES = {
+    "cc_emails": "string",
+    "fwd_emails": "string",
+    "reply_cc_emails": "string",
+    "ticket_cc_emails": "string",
+    "fr_escalated": "boolean",
+    "spam": "boolean",
+    "email_config_id": "bigint",
+    "group_id": "bigint",
+    "priority": "bigint",
+    "requester_id": "bigint",
+    "responder_id": "bigint",
+    "source": "bigint",
+    "company_id": "bigint",
+    "status": "bigint",
+    "subject": "string",
+    "association_type": "bigint",
+    "support_email": "string",
+    "to_emails": "string",
+    "product_id": "bigint",
+    "id": "bigint",
+    "type": "string",
+    "due_by": "string",
+    "fr_due_by": "string",
+    "nr_due_by": "string",
+    "is_escalated": "boolean",
+    "nr_escalated": "boolean",
+    "custom_fields": "string",
+    "created_at": "string",
+    "updated_at": "string",
+    "associated_tickets_count": "bigint",
+    "tags": "string",
+    "conversations": "string"
+}
+
+# Pandas dtypes used for each DSS type, nullable so that all pages share the same dtypes
+PANDAS_DTYPES = {"bigint": "Int64", "boolean": "boolean", "string": "object"}
+
 
-def create_auth_headers(api_key):
+def _build_search_query(ticket_statuses, start=None, end=None):
     """
-    Creates the authentication headers for Freshdesk API requests.
+    Builds a Freshdesk search query for the given statuses and creation dates.
 
     Args:
-        api_key (str): Freshdesk API key.
+        ticket_statuses (list): List of ticket statuses to filter by.
+        start (date, optional): First creation date (inclusive) to filter by.
+        end (date, optional): Last creation date (inclusive) to filter by.
 
     Returns:
-        dict: A dictionary containing the authentication headers.
+        str: The search query, without the surrounding double quotes.
     """
-    auth_string = f"{api_key}:X"
-    auth_bytes = auth_string.encode('ascii')
-    base64_auth = base64.b64encode(auth_bytes).decode('ascii')
+    clauses = []
+    if ticket_statuses:
+        clauses.append("(" + " OR ".join([f"status:{status}" for status in ticket_statuses]) + ")")
+    if start is not None:
+        clauses.append(f"created_at:>'{start.isoformat()}'")
+    if end is not None:
+        clauses.append(f"created_at:<'{end.isoformat()}'")
+    return " AND ".join(clauses)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Basic {base64_auth}"
-    }
-    return headers
 
+def _search_page(session, cache, url, query, page):
+    """
+    Fetches a single page of search results.
+
+    Args:
+        session (requests.Session): Authenticated Freshdesk session.
+        cache (ResponseCache): Cache of Freshdesk responses.
+        url (str): URL of the search endpoint.
+        query (str): Search query.
+        page (int): Page number, starting at 1.
 
-def fetch_tickets(api_key, domain, ticket_statuses):
+    Returns:
+        dict: The search response, with the "total" and "results" keys.
     """
-    Fetches tickets from Freshdesk using the search API.
+    logger.debug(f"Fetching page {page} of query {query}")
+    return cache.get_json(session, url, params={"query": f"\"{query}\"", "page": page})
+
+
+def _search_remaining_pages(session, cache, url, query, first_page):
+    """
+    Yields the tickets of each page of results, fetching the pages following the first
+    one concurrently as the total number of results is known once it has been retrieved.
 
     Args:
-        api_key (str): Freshdesk API key.
+        session (requests.Session): Authenticated Freshdesk session.
+        cache (ResponseCache): Cache of Freshdesk responses.
+        url (str): URL of the search endpoint.
+        query (str): Search query.
+        first_page (dict): The already fetched first page of results.
+
+    Yields:
+        list: The tickets of a page, in page order.
+    """
+    pages = min(math.ceil(first_page.get("total", 0) / SEARCH_PAGE_SIZE), SEARCH_MAX_PAGES)
+    logger.info(f"Fetching {max(pages, 1)} pages for query {query}")
+    yield first_page.get("results", [])
+    if pages > 1:
+        with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+            for data in executor.map(lambda page: _search_page(session, cache, url, query, page), range(2, pages + 1)):
+                yield data.get("results", [])
+
+
+def _search_by_creation_date(session, cache, url, ticket_statuses, start, end):
+    """
+    Yields the tickets created between two dates page by page, recursively halving
+    the date window until each window fits within the search API result limit.
+
+    Args:
+        session (requests.Session): Authenticated Freshdesk session.
+        cache (ResponseCache): Cache of Freshdesk responses.
+        url (str): URL of the search endpoint.
+        ticket_statuses (list): List of ticket statuses to filter by.
+        start (date): First creation date (inclusive).
+        end (date): Last creation date (inclusive).
+
+    Yields:
+        list: The tickets of a page of results.
+    """
+    query = _build_search_query(ticket_statuses, start, end)
+    first_page = _search_page(session, cache, url, query, 1)
+    total = first_page.get("total", 0)
+
+    if total > SEARCH_MAX_RESULTS:
+        if start < end:
+            middle = start + timedelta(days=(end - start).days // 2)
+            yield from _search_by_creation_date(session, cache, url, ticket_statuses, start, middle)
+            yield from _search_by_creation_date(session, cache, url, ticket_statuses, middle + timedelta(days=1), end)
+            return
+        logger.warning(f"{total} tickets were created on {start}, only the first {SEARCH_MAX_RESULTS} are fetched.")
+
+    yield from _search_remaining_pages(session, cache, url, query, first_page)
+
+
+def fetch_tickets(session, domain, ticket_statuses, cache):
+    """
+    Fetches tickets from Freshdesk using the search API, page by page.
+
+    The search API returns at most 300 results per query. When more tickets match,
+    the search is split into creation date windows that each fit within this limit.
+
+    Args:
+        session (requests.Session): Authenticated Freshdesk session.
         domain (str): Freshdesk domain.
         ticket_statuses (list): List of ticket statuses to filter by.
+        cache (ResponseCache): Cache of Freshdesk responses.
 
-    Returns:
-        list: A list of tickets.
+    Yields:
+        list: The tickets of a page of results.
     """
     logger.info("Fetching tickets from Freshdesk.")
-    base_url = f"https://{domain}/api/v2/search/tickets"
-    headers = create_auth_headers(api_key)
+    url = f"https://{domain}/api/v2/search/tickets"
 
-    # Build the query for ticket statuses
-    if ticket_statuses:
-        status_query = " OR ".join([f"status:{status}" for status in ticket_statuses])
-        query = f"query=\"{status_query}\""
+    query = _build_search_query(ticket_statuses)
+    first_page = _search_page(session, cache, url, query, 1)
+    total = first_page.get("total", 0)
+
+    if total > SEARCH_MAX_RESULTS:
+        logger.info(f"{total} tickets match, splitting the search by creation date.")
+        # Tomorrow is used as upper bound so that no time zone offset excludes today's tickets
+        yield from _search_by_creation_date(session, cache, url, ticket_statuses, SEARCH_START_DATE, date.today() + timedelta(days=1))
     else:
-        query = "query=\"\""
-
-    url = f"{base_url}?{query}"
-    logger.debug(f"Constructed URL: {url}")
-    all_tickets = []
-
-    page = 1
-    while True:
-        paginated_url = f"{url}&page={page}"
-        logger.debug(f"Fetching page {page} with URL: {paginated_url}")
-        response = requests.get(paginated_url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-
-        # Append tickets from the current page
-        tickets = data.get("results", [])
-        logger.info(f"Fetched {len(tickets)} tickets from page {page}.")
-        all_tickets.extend(tickets)
-
-        # Check if there are more pages
-        if not tickets:
-            logger.info("No more pages to fetch.")
-            break
-        page += 1
+        yield from _search_remaining_pages(session, cache, url, query, first_page)
 
-    logger.info(f"Total tickets fetched: {len(all_tickets)}")
-    return all_tickets
 
+def _fetch_one(session, cache, domain, ticket):
+    """
+    Fetches the conversations of a single ticket.
 
-def fetch_conversations(api_key, domain, tickets):
+    Args:
+        session (requests.Session): Authenticated Freshdesk session.
+        cache (ResponseCache): Cache of Freshdesk responses.
+        domain (str): Freshdesk domain.
+        ticket (dict): The ticket to fetch conversations for.
+
+    Returns:
+        tuple: The ticket ID and the list of filtered conversations.
+    """
+    ticket_id = ticket["id"]
+    conversations_url = f"https://{domain}/api/v2/tickets/{ticket_id}/conversations"
+    logger.debug(f"Fetching conversations for ticket ID {ticket_id} with URL: {conversations_url}")
+    try:
+        conversations = cache.get_json(session, conversations_url)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        # ValueError covers malformed JSON responses, which orjson does not report as a RequestException
+        logger.error(f"Error retrieving conversations for ticket ID {ticket_id}: {e}")
+        return ticket_id, []
+
+    # Filter conversations to only keep specified keys
+    filtered_conversations = [
+        {
+            "body_text": conv.get("body_text"),
+            "id": conv.get("id"),
+            "updated_at": conv.get("updated_at"),
+            "from_email": conv.get("from_email"),
+        }
+        for conv in conversations
+    ]
+    return ticket_id, filtered_conversations
+
+
+def fetch_conversations(session, domain, tickets, cache):
     """
     Fetches conversations for each ticket and adds them to the ticket data.
 
+    Requests are I/O-bound, so they are issued concurrently over a shared session.
+
     Args:
-        api_key (str): Freshdesk API key.
+        session (requests.Session): Authenticated Freshdesk session.
         domain (str): Freshdesk domain.
         tickets (list): List of tickets.
+        cache (ResponseCache): Cache of Freshdesk responses.
 
     Returns:
         list: A list of tickets with filtered conversations added.
     """
-    logger.info("Fetching conversations for tickets.")
-    headers = create_auth_headers(api_key)
-
-    for ticket in tickets:
-        ticket_id = ticket.get("id")
-        if ticket_id:
-            conversations_url = f"https://{domain}/api/v2/tickets/{ticket_id}/conversations"
-            logger.debug(f"Fetching conversations for ticket ID {ticket_id} with URL: {conversations_url}")
-            try:
-                response = requests.get(conversations_url, headers=headers)
-                response.raise_for_status()
-                conversations = response.json()
-
-                # Filter conversations to only keep specified keys
-                filtered_conversations = [
-                    {
-                        "body_text": conv.get("body_text"),
-                        "id": conv.get("id"),
-                        "updated_at": conv.get("updated_at"),
-                        "from_email": conv.get("from_email"),
-                    }
-                    for conv in conversations
-                ]
-                ticket["conversations"] = filtered_conversations
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error retrieving conversations for ticket ID {ticket_id}: {e}")
-                ticket["conversations"] = []
+    logger.info(f"Fetching conversations for {len(tickets)} tickets.")
+    tickets_with_id = [ticket for ticket in tickets if ticket.get("id")]
+
+    with ThreadPoolExecutor(max_workers=CONVERSATION_WORKERS) as executor:
+        conversations_by_id = dict(executor.map(lambda ticket: _fetch_one(session, cache, domain, ticket), tickets_with_id))
+
+    for ticket in tickets_with_id:
+        ticket["conversations"] = conversations_by_id[ticket["id"]]
 
     return tickets
 
 
-def get_tickets_as_dataframe(api_key, domain, ticket_statuses):
+def build_schema(columns):
     """
-    Retrieves tickets and their conversations from Freshdesk and stores them in a pandas DataFrame.
+    Builds the output dataset schema of the given ticket columns.
 
     Args:
-        api_key (str): Freshdesk API key.
+        columns (list): Names of the ticket columns.
+
+    Returns:
+        list: The schema columns, fields unknown to TICKET_COLUMN_TYPES being typed as strings.
+    """
+    return [{"name": column, "type": TICKET_COLUMN_TYPES.get(column, "string")} for column in columns]
+
+
+def tickets_to_dataframe(tickets, schema):
+    """
+    Converts tickets to a pandas DataFrame matching the given schema.
+
+    The DataFrame is built column by column with the nullable dtype of each column type,
+    so that every page gets the same dtypes whatever its null values. Nested values
+    (conversations, tags, custom fields, ...) are serialized to JSON strings.
+
+    Args:
+        tickets (list): List of tickets.
+        schema (list): Output schema, as returned by build_schema.
+
+    Returns:
+        pd.DataFrame: A DataFrame with one row per ticket.
+    """
+    data = {}
+    for column in schema:
+        name = column["name"]
+        values = [ticket.get(name) for ticket in tickets]
+        values = [dumps(value).decode('utf-8') if isinstance(value, (list, dict)) else value for value in values]
+        data[name] = pd.Series(values, dtype=PANDAS_DTYPES[column["type"]])
+    return pd.DataFrame(data, columns=[column["name"] for column in schema])
+
+
+def iter_tickets_as_dataframes(session, domain, ticket_statuses, cache):
+    """
+    Retrieves tickets and their conversations from Freshdesk, one page of tickets at a time.
+
+    The dataset is written as pages are retrieved, so its schema must be known before the
+    last page is. It holds the known ticket fields of TICKET_COLUMN_TYPES, plus the other
+    fields of the first page, such as fields added by Freshdesk, typed as strings. Fields
+    outside this schema that only appear in a later page are dropped, with a warning.
+
+    Args:
+        session (requests.Session): Authenticated Freshdesk session.
         domain (str): Freshdesk domain.
         ticket_statuses (list): List of ticket statuses to filter by.
+        cache (ResponseCache): Cache of Freshdesk responses.
 
-    Returns:
-        pd.DataFrame: A DataFrame containing ticket details and conversations.
+    Yields:
+        tuple: The output schema and a DataFrame containing ticket details and conversations.
     """
-    tickets = fetch_tickets(api_key, domain, ticket_statuses)
-    tickets_with_conversations = fetch_conversations(api_key, domain, tickets)
-    return pd.DataFrame(tickets_with_conversations)
+    schema = None
+    for tickets in fetch_tickets(session, domain, ticket_statuses, cache):
+        if not tickets:
+            continue
+        tickets_with_conversations = fetch_conversations(session, domain, tickets, cache)
+        page_columns = dict.fromkeys(key for ticket in tickets_with_conversations for key in ticket)
+        if schema is None:
+            schema = build_schema(list(dict.fromkeys(list(TICKET_COLUMN_TYPES) + list(page_columns))))
+            schema_columns = {column["name"] for column in schema}
+        else:
+            dropped_columns = page_columns.keys() - schema_columns
+            if dropped_columns:
+                logger.warning(f"Dropping fields missing from the first page of tickets: {', '.join(sorted(dropped_columns))}")
+        yield schema, tickets_to_dataframe(tickets_with_conversations, schema)
 
 
 # Retrieve configuration parameters
 api_key = config["freshdesk_api_connection"]["apiKey"]
 domain = config["freshdesk_api_connection"]["freshdesk_domain"]
 ticket_statuses = config["ticket_statuses"]
-
-logger.info("Starting ticket retrieval process.")
-df = get_tickets_as_dataframe(api_key, domain, ticket_statuses)
+cache = ResponseCache(domain, api_key, config.get("cache_ttl", DEFAULT_CACHE_TTL))
 
 # Get the output dataset
 output_name = get_output_names_for_role('data_output')[0]
 output_dataset = dataiku.Dataset(output_name)
 
+logger.info("Starting ticket retrieval process.")
 logger.info(f"Writing tickets to output dataset: {output_name}")
-# Write to the output dataset
-output_dataset.write_with_schema(df)
-logger.info("Tickets successfully written to the output dataset.")
\ No newline at end of file
+# Write each page of tickets as soon as it is retrieved, the schema being declared with the first one
+writer = None
+total_tickets = 0
+try:
+    # The search pages of a window are still being fetched while the conversations of its first pages are,
+    # so the pool holds a connection per worker of both executors
+    with create_session(create_auth_headers(api_key), pool_size=SEARCH_WORKERS + CONVERSATION_WORKERS) as session:
+        for schema, df in iter_tickets_as_dataframes(session, domain, ticket_statuses, cache):
+            if writer is None:
+                output_dataset.write_schema(schema)
+                writer = output_dataset.get_writer()
+            writer.write_dataframe(df)
+            total_tickets += len(df)
+finally:
+    if writer is not None:
+        writer.close()
+
+if writer is None:
+    # No ticket matched: the dataset is emptied, with the known ticket fields as schema
+    output_dataset.write_schema(build_schema(list(TICKET_COLUMN_TYPES)))
+    with output_dataset.get_writer():
+        pass
+logger.info(f"{total_tickets} tickets successfully written to the output dataset.")
\ No newline at end of file
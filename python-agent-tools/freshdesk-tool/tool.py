@@ -1,8 +1,49 @@
 from dataiku.llm.agent_tools import BaseAgentTool
+from concurrent.futures import ThreadPoolExecutor
+from freshdesktool.cache import DEFAULT_CACHE_TTL, ResponseCache, TTLCache
+from freshdesktool.serialization import dumps, parse_response
+from freshdesktool.session import create_auth_headers, create_session
 import requests
 import logging
-import base64
-import json
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds during which a ticket fetched to check its requester is reused, kept short as tickets are mutable
+TICKET_CACHE_TTL = 30
+# Maximum number of tickets kept in memory
+TICKET_CACHE_SIZE = 1024
+
+# Fields required by each action, on top of the action itself
+CREATE_TICKET_REQUIRED_FIELDS = frozenset(["subject", "description", "requester_email", "name"])
+TICKET_REQUIRED_FIELDS = frozenset(["ticket_id", "requester_email"])
+TICKETS_BY_EMAIL_REQUIRED_FIELDS = frozenset(["requester_email"])
+UPDATE_PRIORITY_REQUIRED_FIELDS = frozenset(["ticket_id", "requester_email", "priority"])
+
+# Priorities (1=Low to 4=Urgent) and statuses (2=Open to 5=Closed) accepted by Freshdesk
+VALID_PRIORITIES = frozenset((1, 2, 3, 4))
+VALID_STATUSES = frozenset((2, 3, 4, 5))
+# Priority and status labels, indexed by value
+PRIORITY_LEVELS = ("", "Low", "Medium", "High", "Urgent")
+STATUS_LEVELS = ("", "", "Open", "Pending", "Resolved", "Closed")
+# Labels shown next to the allowed values of the input fields that have them
+VALUE_LABELS = {"priority": PRIORITY_LEVELS, "status": STATUS_LEVELS}
+
+# Python types of the JSON schema types used in the tool input
+SCHEMA_TYPES = {"integer": int, "string": str, "array": list}
+
+# The list tickets API returns at most 100 tickets per page
+LIST_PAGE_SIZE = 100
+# Maximum number of pages fetched when listing the tickets of a requester
+LIST_MAX_PAGES = 10
+
+# Threads sending the audit notes of successful ticket updates in the background, shared by all tool instances
+REQUEST_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="freshdesk-tool")
+
+# The runtime creates a tool instance per request, so connections and caches are shared by all instances
+# (domain, API key, cache TTL) -> (session, response cache, ticket cache)
+SHARED_CLIENTS = {}
+SHARED_CLIENTS_LOCK = threading.Lock()
 
 class FreshdeskTool(BaseAgentTool):
     def set_config(self, config, plugin_config):
@@ -11,8 +52,38 @@ class FreshdeskTool(BaseAgentTool):
         self.domain = self.config["freshdesk_api_connection"]["freshdesk_domain"]
         self.ticket_types = self.config["freshdesk_api_connection"]["ticket_types"]
         self.base_url = f"https://{self.domain}/api/v2"
+        self._helpdesk_prefix = f"https://{self.domain}/helpdesk/tickets/"
+        cache_ttl = self.config.get("cache_ttl", DEFAULT_CACHE_TTL)
+
+        with SHARED_CLIENTS_LOCK:
+            key = (self.domain, self.api_key, cache_ttl)
+            if key not in SHARED_CLIENTS:
+                SHARED_CLIENTS[key] = (
+                    create_session(create_auth_headers(self.api_key)),
+                    ResponseCache(self.domain, self.api_key, cache_ttl),
+                    # Ticket endpoint -> ticket with requester
+                    TTLCache(TICKET_CACHE_SIZE, TICKET_CACHE_TTL)
+                )
+            self.session, self.cache, self._ticket_cache = SHARED_CLIENTS[key]
+
+        # Action -> (required fields, handler)
+        self._actions = {
+            "create_ticket": (CREATE_TICKET_REQUIRED_FIELDS, self._create_ticket),
+            "get_ticket_by_id": (TICKET_REQUIRED_FIELDS, self._get_ticket_by_id),
+            "get_tickets_by_email": (TICKETS_BY_EMAIL_REQUIRED_FIELDS, self._get_tickets_by_email),
+            "close_ticket": (TICKET_REQUIRED_FIELDS, self._close_ticket),
+            "update_ticket_priority": (UPDATE_PRIORITY_REQUIRED_FIELDS, self._update_ticket_priority)
+        }
+
+        # The descriptor only depends on the configuration, so it is built once, along with
+        # the input validators derived from its schema
+        self._descriptor = self._build_descriptor()
+        self._validators = self._compile_validators()
 
     def get_descriptor(self, tool):
+        return self._descriptor
+
+    def _build_descriptor(self):
         return {
             "description": "Interacts with Freshdesk to create, retrieve, close, and update support tickets",
             "inputSchema": {
@@ -33,6 +104,10 @@ class FreshdeskTool(BaseAgentTool):
                         "type": "string",
                         "description": "Requester's email address (required for get_ticket_by_id, get_tickets_by_email, close_ticket, or update_ticket_priority)"
                     },
+                    "updated_since": {
+                        "type": "string",
+                        "description": "Only return tickets updated since this date, in ISO 8601 format such as 2025-01-31T00:00:00Z (optional for get_tickets_by_email)"
+                    },
                     "subject": {
                         "type": "string",
                         "description": "Ticket subject (required for create_ticket action)"
@@ -59,12 +134,12 @@ class FreshdeskTool(BaseAgentTool):
                     },
                     "priority": {
                         "type": "integer",
-                        "enum": [1, 2, 3, 4],
+                        "enum": sorted(VALID_PRIORITIES),
                         "description": "Ticket priority (1=Low, 2=Medium, 3=High, 4=Urgent) (required for update_ticket_priority action)"
                     },
                     "status": {
                         "type": "integer",
-                        "enum": [2, 3, 4, 5],
+                        "enum": sorted(VALID_STATUSES),
                         "description": "Ticket status (2=Open, 3=Pending, 4=Resolved, 5=Closed)"
                     }
                 },
@@ -72,78 +147,143 @@ class FreshdeskTool(BaseAgentTool):
             }
         }
 
-    def _make_request(self, method, endpoint, data=None, params=None):
-        # Create base64 encoded API key
-        auth_string = f"{self.api_key}:X"  # Freshdesk requires ':X' suffix
-        auth_bytes = auth_string.encode('ascii')
-        base64_bytes = base64.b64encode(auth_bytes)
-        base64_auth = base64_bytes.decode('ascii')
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Basic {base64_auth}"
-        }
+    def _make_request(self, method, endpoint, data=None, params=None, max_age=None):
         url = f"{self.base_url}/{endpoint}"
         
+        # The payload is serialized once, and the same bytes are logged and sent
+        body = dumps(data) if data is not None else None
+
         try:
             # Log the request details for debugging
-            logging.info(f"Making {method} request to {url}")
-            if data:
-                logging.info(f"Request data: {json.dumps(data, indent=2)}")
+            logger.info("Making %s request to %s", method, url)
+            debug_enabled = logger.isEnabledFor(logging.DEBUG)
+            if data and debug_enabled:
+                logger.debug("Request data: %s", body.decode("utf-8"))
             if params:
-                logging.info(f"Request params: {params}")
-            
-            response = requests.request(method, url, headers=headers, json=data, params=params)
+                logger.debug("Request params: %s", params)
+
+            if method == "GET":
+                return self.cache.get_json(self.session, url, params=params, max_age=max_age)
+
+            response = self.session.request(method, url, data=body, params=params)
             
             # Log response details for debugging
-            logging.info(f"Response status code: {response.status_code}")
-            logging.info(f"Response headers: {dict(response.headers)}")
-            logging.info(f"Response body: {response.text}")
+            logger.debug("Response status code: %s", response.status_code)
+            if debug_enabled:
+                # Formatted from the header items, as the repr of CaseInsensitiveDict copies it to a dict
+                logger.debug("Response headers: %s", ", ".join(f"{name}: {value}" for name, value in response.headers.items()))
+                logger.debug("Response body: %s", response.text)
             
             response.raise_for_status()
-            return response.json()
+
+            # Drop the cached responses of the modified ticket, if any (a creation leaves the other tickets
+            # untouched), and the cached ticket lists and searches, which embed the ticket
+            ticket_endpoint = "/".join(endpoint.split("/")[:2])
+            if ticket_endpoint != "tickets":
+                self._ticket_cache.pop(ticket_endpoint, None)
+                self.cache.invalidate(f"{self.base_url}/{ticket_endpoint}")
+            self.cache.invalidate(f"{self.base_url}/tickets", subresources=False)
+            self.cache.invalidate(f"{self.base_url}/search/tickets", subresources=False)
+            return parse_response(response)
         except requests.exceptions.RequestException as e:
-            logging.error(f"Freshdesk API error: {str(e)}")
+            logger.error(f"Freshdesk API error: {str(e)}")
             if hasattr(e.response, 'text'):
-                logging.error(f"Error response: {e.response.text}")
+                logger.error(f"Error response: {e.response.text}")
             raise
 
+    def _ticket_url(self, ticket_id):
+        return self._helpdesk_prefix + str(ticket_id)
+
+    def _verify_and_fetch(self, ticket_id, expected_email):
+        ticket = self._get_ticket_with_requester(ticket_id)
+        requester = ticket.get("requester")
+        if requester is None or requester.get("email") != expected_email:
+            raise ValueError("The provided requester email does not match the ticket's requester email")
+        return ticket
+
+    def _get_ticket_with_requester(self, ticket_id):
+        endpoint = f"tickets/{ticket_id}"
+        ticket = self._ticket_cache.get(endpoint)
+        if ticket is None:
+            # Ticket state is mutable, so the stored copy is always revalidated against its ETag
+            ticket = self._make_request("GET", endpoint, params={"include": "requester"}, max_age=0)
+            self._ticket_cache[endpoint] = ticket
+        return ticket
+
+    def _update_ticket_with_note(self, ticket_id, update_data, note_data):
+        # The note is public and tells the requester the change was made, so it is only sent once the update succeeded.
+        # The caller does not wait for this audit trail, which is sent in the background
+        result = self._make_request("PUT", f"tickets/{ticket_id}", update_data)
+        REQUEST_EXECUTOR.submit(self._add_note, ticket_id, note_data)
+        return result
+
+    def _add_note(self, ticket_id, note_data):
+        try:
+            self._make_request("POST", f"tickets/{ticket_id}/notes", note_data)
+        except Exception:
+            # Nobody waits on this call, so failures would otherwise go unnoticed
+            logger.exception(f"Failed to add note to Freshdesk ticket #{ticket_id}")
+
     def invoke(self, input, trace):
-        args = input["input"]
-        action = args["action"]
-
-        if action == "create_ticket":
-            return self._create_ticket(args)
-        elif action == "get_ticket_by_id":
-            return self._get_ticket_by_id(args)
-        elif action == "get_tickets_by_email":
-            return self._get_tickets_by_email(args)
-        elif action == "close_ticket":
-            return self._close_ticket(args)
-        elif action == "update_ticket_priority":
-            return self._update_ticket_priority(args)
-        else:
+        # Callers may send null for the fields they do not use: these fields are treated as not provided
+        args = {field: value for field, value in input["input"].items() if value is not None}
+        action = args.get("action")
+
+        if action not in self._actions:
             raise ValueError(f"Invalid action: {action}")
+        required_fields, handler = self._actions[action]
 
-    def _create_ticket(self, args):
-        # Validate required fields
-        required_fields = ["subject", "description", "requester_email", "name"]
-        for field in required_fields:
-            if field not in args:
-                raise ValueError(f"Missing required field: {field}")
+        missing_fields = required_fields - args.keys()
+        if missing_fields:
+            raise ValueError(f"Missing required field: {', '.join(sorted(missing_fields))}")
+        self._validate_values(args)
+
+        return handler(args)
+
+    def _compile_validators(self):
+        # Field -> (schema type, Python type, set of allowed values or None, description of the allowed values,
+        # (item schema type, item Python type) of arrays or None)
+        validators = {}
+        for field, field_schema in self._descriptor["inputSchema"]["properties"].items():
+            item_type = None
+            if "items" in field_schema:
+                item_type = (field_schema["items"]["type"], SCHEMA_TYPES[field_schema["items"]["type"]])
+            allowed_values = field_schema.get("enum")
+            allowed_set = None
+            allowed_description = None
+            if allowed_values is not None:
+                allowed_set = frozenset(allowed_values)
+                labels = VALUE_LABELS.get(field)
+                if labels is None:
+                    allowed_description = ", ".join(str(value) for value in allowed_values)
+                else:
+                    allowed_description = ", ".join(f"{value} ({labels[value]})" for value in allowed_values)
+            validators[field] = (
+                field_schema["type"], SCHEMA_TYPES[field_schema["type"]], allowed_set, allowed_description, item_type
+            )
+        return validators
+
+    def _validate_values(self, args):
+        for field, value in args.items():
+            validator = self._validators.get(field)
+            if validator is None:
+                continue
+            schema_type, python_type, allowed_set, allowed_description, item_type = validator
 
-        # Validate priority value
-        if "priority" in args and args["priority"] not in [1, 2, 3, 4]:
-            raise ValueError("Priority must be one of: 1 (Low), 2 (Medium), 3 (High), 4 (Urgent)")
+            # bool is a subclass of int but is not a valid integer in JSON schema
+            if isinstance(value, bool) or not isinstance(value, python_type):
+                raise ValueError(f"{field} must be of type {schema_type}")
 
-        # Validate status if provided
-        if "status" in args and args["status"] not in [2, 3, 4, 5]:
-            raise ValueError("Status must be one of: 2 (Open), 3 (Pending), 4 (Resolved), 5 (Closed)")
+            if allowed_set is not None and value not in allowed_set:
+                raise ValueError(f"{field} must be one of: {allowed_description}")
 
-        # Validate type if provided
-        if "type" in args and args["type"] not in self.ticket_types:
-            raise ValueError(f"Type must be one of: {', '.join(self.ticket_types)}")
+            if item_type is not None:
+                item_schema_type, item_python_type = item_type
+                for item in value:
+                    if isinstance(item, bool) or not isinstance(item, item_python_type):
+                        raise ValueError(f"{field} must be an array of {item_schema_type} values")
 
+    def _create_ticket(self, args):
         # Format ticket data
         ticket_data = {
             "subject": args["subject"],
@@ -159,11 +299,12 @@ class FreshdeskTool(BaseAgentTool):
             ticket_data["tags"] = args["tags"]
 
         result = self._make_request("POST", "tickets", ticket_data)
+        url = self._ticket_url(result["id"])
         return {
             "output": {
                 "message": "Ticket created successfully",
                 "ticket_id": result["id"],
-                "url": f"https://{self.domain}/helpdesk/tickets/{result['id']}",
+                "url": url,
                 "ticket": result
             },
             "sources": [{
@@ -171,27 +312,20 @@ class FreshdeskTool(BaseAgentTool):
                 "items": [{
                     "type": "SIMPLE_DOCUMENT",
                     "title": f"Ticket #{result['id']}",
-                    "url": f"https://{self.domain}/helpdesk/tickets/{result['id']}"
+                    "url": url
                 }]
             }]
         }
 
     def _get_ticket_by_id(self, args):
-        required_fields = ["ticket_id", "requester_email"]
-        for field in required_fields:
-            if field not in args:
-                raise ValueError(f"Missing required field: {field}")
-                    
-        result = self._make_request("GET", f"tickets/{args['ticket_id']}", params={"include": "requester"})
-        
-        if result.get("requester", {}).get("email") != args["requester_email"]:
-            raise ValueError("The provided requester email does not match the ticket's requester email")
+        result = self._verify_and_fetch(args["ticket_id"], args["requester_email"])
         
+        url = self._ticket_url(result["id"])
         return {
             "output": {
                 "message": "Ticket retrieved successfully",
                 "ticket_id": result["id"],
-                "url": f"https://{self.domain}/helpdesk/tickets/{result['id']}",
+                "url": url,
                 "ticket": result
             },
             "sources": [{
@@ -199,31 +333,49 @@ class FreshdeskTool(BaseAgentTool):
                 "items": [{
                     "type": "SIMPLE_DOCUMENT",
                     "title": f"Ticket #{result['id']}",
-                    "url": f"https://{self.domain}/helpdesk/tickets/{result['id']}"
+                    "url": url
                 }]
             }]
         }
 
     def _get_tickets_by_email(self, args):
-        if "requester_email" not in args:
-            raise ValueError("Missing required field: requester_email")
-                
-        result = self._make_request("GET", "tickets", params={"email": args["requester_email"]})
-        
-        for ticket in result:
-            ticket["url"] = f"https://{self.domain}/helpdesk/tickets/{ticket['id']}"
-        
+        params = {"email": args["requester_email"], "per_page": LIST_PAGE_SIZE}
+        if "updated_since" in args:
+            params["updated_since"] = args["updated_since"]
+
+        # The number of pages is not known upfront, so pages are fetched until a partial one is returned
+        result = []
+        truncated = False
+        for page in range(1, LIST_MAX_PAGES + 1):
+            tickets = self._make_request("GET", "tickets", params=dict(params, page=page))
+            result.extend(tickets)
+            if len(tickets) < LIST_PAGE_SIZE:
+                break
+        else:
+            # The last allowed page was full, so more tickets may exist
+            truncated = True
+            logger.warning(f"Stopped listing the tickets of {args['requester_email']} after {len(result)} tickets")
+
+        # Attributes are bound locally as this loop runs once per ticket of the requester
+        prefix = self._helpdesk_prefix
         items = []
+        items_append = items.append
         for ticket in result:
-            items.append({
+            ticket_id = ticket["id"]
+            url = prefix + str(ticket_id)
+            ticket["url"] = url
+            items_append({
                 "type": "SIMPLE_DOCUMENT",
-                "title": f"Ticket #{ticket['id']}",
-                "url": f"https://{self.domain}/helpdesk/tickets/{ticket['id']}"
+                "title": f"Ticket #{ticket_id}",
+                "url": url
             })
         
+        message = f"Found {len(result)} tickets for requester {args['requester_email']}"
+        if truncated:
+            message += f" (results truncated to the first {len(result)} tickets, more may exist)"
         return {
             "output": {
-                "message": f"Found {len(result)} tickets for requester {args['requester_email']}",
+                "message": message,
                 "tickets": result
             },
             "sources": [{
@@ -233,22 +385,15 @@ class FreshdeskTool(BaseAgentTool):
         }
 
     def _close_ticket(self, args):
-        required_fields = ["ticket_id", "requester_email"]
-        for field in required_fields:
-            if field not in args:
-                raise ValueError(f"Missing required field: {field}")
-        
-        ticket = self._make_request("GET", f"tickets/{args['ticket_id']}", params={"include": "requester"})
-        
-        if ticket.get("requester", {}).get("email") != args["requester_email"]:
-            raise ValueError("The provided requester email does not match the ticket's requester email")
+        ticket = self._verify_and_fetch(args["ticket_id"], args["requester_email"])
         
         if ticket.get("status") == 5:
+            url = self._ticket_url(ticket["id"])
             return {
                 "output": {
                     "message": "Ticket is already closed",
                     "ticket_id": ticket["id"],
-                    "url": f"https://{self.domain}/helpdesk/tickets/{ticket['id']}",
+                    "url": url,
                     "ticket": ticket
                 },
                 "sources": [{
@@ -256,7 +401,7 @@ class FreshdeskTool(BaseAgentTool):
                     "items": [{
                         "type": "SIMPLE_DOCUMENT",
                         "title": f"Ticket #{ticket['id']}",
-                        "url": f"https://{self.domain}/helpdesk/tickets/{ticket['id']}"
+                        "url": url
                     }]
                 }]
             }
@@ -264,20 +409,18 @@ class FreshdeskTool(BaseAgentTool):
         update_data = {
             "status": 5
         }
-        
-        result = self._make_request("PUT", f"tickets/{args['ticket_id']}", update_data)
-        
         note_data = {
             "body": f"Ticket closed as requested by the original requester ({args['requester_email']})",
             "private": False
         }
-        self._make_request("POST", f"tickets/{args['ticket_id']}/notes", note_data)
+        result = self._update_ticket_with_note(args["ticket_id"], update_data, note_data)
         
+        url = self._ticket_url(result["id"])
         return {
             "output": {
                 "message": "Ticket closed successfully",
                 "ticket_id": result["id"],
-                "url": f"https://{self.domain}/helpdesk/tickets/{result['id']}",
+                "url": url,
                 "ticket": result
             },
             "sources": [{
@@ -285,31 +428,21 @@ class FreshdeskTool(BaseAgentTool):
                 "items": [{
                     "type": "SIMPLE_DOCUMENT",
                     "title": f"Ticket #{result['id']}",
-                    "url": f"https://{self.domain}/helpdesk/tickets/{result['id']}"
+                    "url": url
                 }]
             }]
         }
 
     def _update_ticket_priority(self, args):
-        required_fields = ["ticket_id", "requester_email", "priority"]
-        for field in required_fields:
-            if field not in args:
-                raise ValueError(f"Missing required field: {field}")
-        
-        if args["priority"] not in [1, 2, 3, 4]:
-            raise ValueError("Priority must be one of: 1 (Low), 2 (Medium), 3 (High), 4 (Urgent)")
-        
-        ticket = self._make_request("GET", f"tickets/{args['ticket_id']}", params={"include": "requester"})
-        
-        if ticket.get("requester", {}).get("email") != args["requester_email"]:
-            raise ValueError("The provided requester email does not match the ticket's requester email")
+        ticket = self._verify_and_fetch(args["ticket_id"], args["requester_email"])
         
         if ticket.get("priority") == args["priority"]:
+            url = self._ticket_url(ticket["id"])
             return {
                 "output": {
                     "message": "Ticket priority is already at the requested level",
                     "ticket_id": ticket["id"],
-                    "url": f"https://{self.domain}/helpdesk/tickets/{ticket['id']}",
+                    "url": url,
                     "ticket": ticket
                 },
                 "sources": [{
@@ -317,7 +450,7 @@ class FreshdeskTool(BaseAgentTool):
                     "items": [{
                         "type": "SIMPLE_DOCUMENT",
                         "title": f"Ticket #{ticket['id']}",
-                        "url": f"https://{self.domain}/helpdesk/tickets/{ticket['id']}"
+                        "url": url
                     }]
                 }]
             }
@@ -326,25 +459,18 @@ class FreshdeskTool(BaseAgentTool):
             "priority": args["priority"]
         }
         
-        result = self._make_request("PUT", f"tickets/{args['ticket_id']}", update_data)
-        
-        priority_levels = {
-            1: "Low",
-            2: "Medium",
-            3: "High",
-            4: "Urgent"
-        }
         note_data = {
-            "body": f"Ticket priority updated to {priority_levels[args['priority']]} as requested by the original requester ({args['requester_email']})",
+            "body": f"Ticket priority updated to {PRIORITY_LEVELS[args['priority']]} as requested by the original requester ({args['requester_email']})",
             "private": False
         }
-        self._make_request("POST", f"tickets/{args['ticket_id']}/notes", note_data)
+        result = self._update_ticket_with_note(args["ticket_id"], update_data, note_data)
         
+        url = self._ticket_url(result["id"])
         return {
             "output": {
                 "message": "Ticket priority updated successfully",
                 "ticket_id": result["id"],
-                "url": f"https://{self.domain}/helpdesk/tickets/{result['id']}",
+                "url": url,
                 "ticket": result
             },
             "sources": [{
@@ -352,7 +478,7 @@ class FreshdeskTool(BaseAgentTool):
                 "items": [{
                     "type": "SIMPLE_DOCUMENT",
                     "title": f"Ticket #{result['id']}",
-                    "url": f"https://{self.domain}/helpdesk/tickets/{result['id']}"
+                    "url": url
                 }]
             }]
         }
\ No newline at end of file
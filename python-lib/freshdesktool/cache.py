@@ -0,0 +1,251 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from freshdesktool.serialization import loads, parse_response
+
+logger = logging.getLogger(__name__)
+
+# Default number of seconds a cached response is served without contacting Freshdesk
+DEFAULT_CACHE_TTL = 300
+
+# Seconds after which responses that can still be revalidated with their ETag / Last-Modified are dropped
+CACHE_RETENTION = 7 * 24 * 3600
+
+
+def _default_cache_path():
+    # Responses contain ticket data, so they are kept in a directory private to the Unix user the
+    # plugin runs as (DSS runs each user as a separate account when user isolation is enabled)
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        home = os.path.expanduser("~")
+        if home == "~" or not os.access(home, os.W_OK):
+            home = os.path.join(tempfile.gettempdir(), f"dss-plugin-freshdesk-tool-{os.getuid()}")
+        cache_home = os.path.join(home, ".cache")
+    return os.path.join(cache_home, "dss-plugin-freshdesk-tool", "responses.sqlite")
+
+
+DEFAULT_CACHE_PATH = _default_cache_path()
+
+
+class TTLCache(object):
+    """
+    Thread-safe in-memory cache whose entries expire after a fixed number of seconds.
+
+    When full, the least recently stored entry is evicted.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if time.monotonic() - entry[0] >= self.ttl:
+                del self._entries[key]
+                return default
+            return entry[1]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic(), value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of the JSON responses of Freshdesk GET requests.
+
+    Entries are keyed by URL and query parameters, and namespaced by Freshdesk domain and
+    API key so that accounts and permission levels never share entries. Entries younger
+    than the TTL are served without contacting Freshdesk; older ones are revalidated with
+    their ETag / Last-Modified values, a 304 response renewing them.
+
+    The cache file is only readable by its owner. Expired entries are pruned when the cache
+    is opened, except those that can still be revalidated, which are kept for at most
+    CACHE_RETENTION seconds.
+
+    A TTL of 0 disables the cache: requests are then always sent to Freshdesk. The cache
+    is also disabled, with a warning, if its file cannot be opened.
+    """
+
+    def __init__(self, domain, api_key, ttl=DEFAULT_CACHE_TTL, path=DEFAULT_CACHE_PATH):
+        self.ttl = ttl
+        self._namespace = hashlib.sha256(f"{domain}:{api_key}".encode("utf-8")).hexdigest()
+        self._lock = threading.Lock()
+        self._connection = None
+        if ttl > 0:
+            try:
+                self._connection = self._open(path)
+                self._prune()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Response cache {path} is unavailable, Freshdesk responses will not be cached: {e}")
+                self._connection = None
+
+    @property
+    def enabled(self):
+        return self._connection is not None
+
+    @staticmethod
+    def _open(path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.chmod(directory, 0o700)
+        # The file is created with owner-only permissions before sqlite opens it, and sqlite
+        # creates its journal files with the permissions of the database file
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "namespace TEXT, key TEXT, url TEXT, body BLOB, etag TEXT, last_modified TEXT, stored_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+        return connection
+
+    def _prune(self):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM responses WHERE stored_at < ? OR (namespace = ? AND stored_at < ? "
+                "AND etag IS NULL AND last_modified IS NULL)",
+                (now - CACHE_RETENTION, self._namespace, now - self.ttl)
+            )
+
+    def get_json(self, session, url, params=None, headers=None, max_age=None):
+        """
+        Returns the parsed JSON response of a GET request, from the cache when possible.
+
+        Args:
+            session (requests.Session): Session used on cache misses and revalidations.
+            url (str): URL of the resource.
+            params (dict, optional): Query parameters.
+            headers (dict, optional): Request headers.
+            max_age (int, optional): Age in seconds after which the cached response is
+                revalidated, defaulting to the cache TTL. Use 0 to always revalidate, so
+                that only a 304 response is transferred when the resource is unchanged.
+
+        Returns:
+            The parsed JSON response.
+
+        Raises:
+            requests.exceptions.RequestException: If the request to Freshdesk fails.
+        """
+        if not self.enabled:
+            response = session.get(url, params=params, headers=headers)
+            response.raise_for_status()
+            return parse_response(response)
+
+        if max_age is None:
+            max_age = self.ttl
+
+        key = self._key(url, params)
+        try:
+            entry = self._load(key)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to read {key} from the response cache: {e}")
+            entry = None
+        if entry is not None and time.time() - entry["stored_at"] < max_age:
+            logger.debug(f"Serving {key} from cache")
+            return loads(entry["body"])
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry["etag"]:
+                request_headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = session.get(url, params=params, headers=request_headers)
+        if response.status_code == 304 and entry is not None:
+            logger.debug(f"Cached response for {key} is still valid")
+            try:
+                self._renew(key)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to renew {key} in the response cache: {e}")
+            return loads(entry["body"])
+
+        response.raise_for_status()
+        # The response is parsed before being stored, so that malformed responses are never cached
+        data = parse_response(response)
+        try:
+            self._store(key, url, response)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to store {key} in the response cache: {e}")
+        return data
+
+    def invalidate(self, url, subresources=True):
+        """
+        Removes the cached responses of a resource, with any query parameters, and by default
+        of all its sub-resources.
+
+        Args:
+            url (str): URL of the resource, without query parameters.
+            subresources (bool): Whether to also remove the responses of the sub-resources.
+        """
+        if not self.enabled:
+            return
+        try:
+            with self._lock, self._connection:
+                if subresources:
+                    self._connection.execute(
+                        "DELETE FROM responses WHERE namespace = ? AND (url = ? OR url LIKE ?)",
+                        (self._namespace, url, url + "/%")
+                    )
+                else:
+                    self._connection.execute(
+                        "DELETE FROM responses WHERE namespace = ? AND url = ?",
+                        (self._namespace, url)
+                    )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to invalidate {url} in the response cache: {e}")
+
+    @staticmethod
+    def _key(url, params):
+        if not params:
+            return url
+        return f"{url}?{urlencode(sorted(params.items()))}"
+
+    def _load(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT body, etag, last_modified, stored_at FROM responses WHERE namespace = ? AND key = ?",
+                (self._namespace, key)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"body": row[0], "etag": row[1], "last_modified": row[2], "stored_at": row[3]}
+
+    def _store(self, key, url, response):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._namespace, key, url, response.content, response.headers.get("ETag"),
+                 response.headers.get("Last-Modified"), time.time())
+            )
+
+    def _renew(self, key):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE responses SET stored_at = ? WHERE namespace = ? AND key = ?",
+                (time.time(), self._namespace, key)
+            )
@@ -0,0 +1,49 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(content):
+    """
+    Parses a JSON document, using orjson when it is installed.
+
+    Args:
+        content (bytes): The raw JSON document.
+
+    Returns:
+        The parsed document.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def dumps(data):
+    """
+    Serializes data to a UTF-8 encoded JSON document, using orjson when it is installed.
+
+    Args:
+        data: The data to serialize.
+
+    Returns:
+        bytes: The JSON document.
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def parse_response(response):
+    """
+    Parses the JSON body of a response from its raw bytes.
+
+    Args:
+        response (requests.Response): A response with a JSON body.
+
+    Returns:
+        The parsed body.
+    """
+    return loads(response.content)
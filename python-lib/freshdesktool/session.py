@@ -0,0 +1,104 @@
+import base64
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Default number of connections kept open to Freshdesk
+DEFAULT_POOL_SIZE = 20
+
+# Default (connect, read) timeouts in seconds of Freshdesk requests
+DEFAULT_TIMEOUT = (3.05, 30)
+
+
+class FullJitterRetry(Retry):
+    """
+    Retry policy sleeping for a random duration between 0 and the exponential backoff
+    ("full jitter"), so that clients rate-limited at the same time do not retry in
+    lockstep. A Retry-After header sent by Freshdesk still takes precedence.
+
+    POST requests are not idempotent and are only retried on HTTP 429, as Freshdesk
+    has then not processed them.
+    """
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return status_code == 429 and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter applying a default timeout to the requests that do not set one.
+    """
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def create_auth_headers(api_key):
+    """
+    Creates the authentication headers for Freshdesk API requests.
+
+    Compressed responses are explicitly accepted, as ticket and conversation payloads
+    compress well.
+
+    Args:
+        api_key (str): Freshdesk API key.
+
+    Returns:
+        dict: A dictionary containing the authentication headers.
+    """
+    # Freshdesk uses Basic authentication with the API key as user and 'X' as password
+    auth_string = f"{api_key}:X"
+    auth_bytes = auth_string.encode('ascii')
+    base64_auth = base64.b64encode(auth_bytes).decode('ascii')
+
+    headers = {
+        "Content-Type": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "Authorization": f"Basic {base64_auth}"
+    }
+    return headers
+
+
+def create_session(headers, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Creates a requests session authenticated against the Freshdesk API.
+
+    Connections are kept alive and reused across requests, and requests time out after
+    DEFAULT_TIMEOUT instead of possibly hanging forever. Rate-limited (HTTP 429) and
+    failed (HTTP 5xx) requests are retried with jittered exponential backoff, honoring
+    the delay given by Freshdesk in the Retry-After header.
+
+    Args:
+        headers (dict): Authentication headers, as returned by create_auth_headers.
+        pool_size (int): Maximum number of connections kept open to Freshdesk, which
+            should be at least the number of threads sharing the session.
+
+    Returns:
+        requests.Session: A session with the authentication headers set.
+    """
+    session = requests.Session()
+    session.headers.update(headers)
+    retries = FullJitterRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "PUT"]),
+        respect_retry_after_header=True
+    )
+    adapter = TimeoutHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("https://", adapter)
+    return session